@@ -3,13 +3,23 @@ import os
 import re
 import io
 import json
+import hashlib
 import logging
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import fitz  # PyMuPDF
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, Response, request, jsonify, send_file, send_from_directory
 from flask_cors import cross_origin
 from flask_jwt_extended import jwt_required
 from unidecode import unidecode
 
+try:
+    import orjson  # serializzazione indice più veloce, se disponibile
+except ImportError:
+    orjson = None
+
 attestati_bp = Blueprint("attestati", __name__)
 
 # =============================
@@ -34,9 +44,68 @@ LABELS_STOP = {
 
 IS_PRODUCTION = os.getenv("FLASK_ENV") == "production"
 
+# Versione dell'indicizzazione: se cambia, /reindex rigenera anche con PDF invariato
+INDEX_VERSION = 1
+
+# Indicizzazione parallela solo per PDF grandi: ogni worker riceve almeno
+# INDEX_MIN_PAGES_PER_WORKER pagine contigue (sotto, l'avvio dei processi non ripaga)
+INDEX_MAX_WORKERS = int(os.getenv("INDEX_WORKERS", str(min(os.cpu_count() or 1, 6))))
+INDEX_MIN_PAGES_PER_WORKER = 1000
+
+# Pagine pre-divise su disco (opzionale): ogni file porta con sé sfondi e font
+# condivisi, quindi si rinuncia se lo spazio supera N volte il PDF originale
+SPLIT_PAGES = os.getenv("SPLIT_PAGES", "").lower() in {"1", "true", "yes"}
+SPLIT_PAGES_MAX_RATIO = 3
+
+# Regex precompilate (usate per ogni pagina durante l'indicizzazione)
+_WS_RE = re.compile(r"\s+")
+_APOS_RE = re.compile(r"['’]")
+_ALLCAPS_RE = re.compile(r"[A-ZÀ-Ÿ' \-]+")
+# Caratteri ammessi in un nome in maiuscolo (dopo .upper()):
+# carattere -> (lunghezza in maiuscolo, è lettera, è lettera minuscola)
+_CAPS_CHARS = {
+    ch: (len(ch.upper()), int(ch.isalpha()), int(ch.isalpha() and not ch.isupper()))
+    for ch in map(chr, range(0x10000))
+    if not ch.isspace() and _ALLCAPS_RE.fullmatch(ch.upper())
+}
+_CAPS_CANDIDATE_RE = re.compile(r"[A-ZÀ-Ÿ' \-]{6,}")
+_PETTORALE_RE = re.compile(r"pettorale", re.IGNORECASE)
+# "numero pettorale" / "n° pettorale" / "pettorale" in un'unica passata sul testo
+_BIB_COMBINED = re.compile(
+    r"numero\s*pettorale[^0-9]{0,100}?([0-9]{1,5})"
+    r"|\bn[°o]\s*pettorale[^0-9]{0,50}?([0-9]{1,5})"
+    r"|\bpettorale[^0-9]{0,50}?([0-9]{1,5})",
+    re.IGNORECASE,
+)
+# Traslitterazione precalcolata per Latin-1 (nomi italiani) e apostrofo tipografico,
+# con gli stessi risultati di unidecode + apostrofi -> spazio
+_ACCENT_TABLE = {
+    ord(ch): _APOS_RE.sub(" ", unidecode(ch))
+    for ch in [*map(chr, range(0x80, 0x100)), "’"]
+}
+_ACCENT_TABLE[ord("'")] = " "
+_TWOWORD_RE = re.compile(r"\b([A-Z][a-zà-ÿ]+)\s+([A-Z][a-zà-ÿ]+)\b")
+
 # Logging
 logger = logging.getLogger(__name__)
 
+# Cache indici in memoria: gara_id -> (mtime di index.json, indice, trigramma -> nomi)
+_INDEX_CACHE: dict[str, tuple[float, dict, dict[str, set[str]]]] = {}
+
+# Elenco gare: (mtime_ns della cartella uploads, gare)
+_GARE_CACHE: tuple[int, list] | None = None
+
+# Documenti PDF già aperti: pdf_path -> (mtime, documento, lock per l'accesso)
+_DOC_CACHE: dict[str, tuple[float, fitz.Document, threading.Lock]] = {}
+_DOC_CACHE_LOCK = threading.Lock()
+
+# LRU dei PDF a pagina singola già estratti: (pdf_path, pagina, mtime) -> bytes,
+# limitata per dimensione totale (una pagina con sfondo può pesare centinaia di KB)
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_MB", "8")) * 1024 * 1024
+_PAGE_CACHE: OrderedDict[tuple[str, int, float], bytes] = OrderedDict()
+_PAGE_CACHE_BYTES = 0
+_PAGE_CACHE_LOCK = threading.Lock()
+
 # =============================
 #   UTIL
 # =============================
@@ -48,11 +117,12 @@ def norm(s: str) -> str:
     """Normalizza per ricerche case/accents/apostrofi-insensitive."""
     if not s:
         return ""
-    s = s.replace("’", "'")
-    s = unidecode(s)                      # rimuove accenti
-    s = re.sub(r"['’]", " ", s)          # apostrofi -> spazio (D'ANGELO -> D ANGELO)
-    s = re.sub(r"\s+", " ", s).strip().lower()
-    return s
+    t = s.translate(_ACCENT_TABLE)         # Latin-1: accenti e apostrofi in un colpo
+    if not t.isascii():
+        # Caratteri fuori tabella: percorso completo con unidecode
+        t = unidecode(s.replace("’", "'"))
+        t = _APOS_RE.sub(" ", t)         # apostrofi -> spazio (D'ANGELO -> D ANGELO)
+    return _WS_RE.sub(" ", t).strip().lower()
 
 def get_gara_folder(gara_id: str) -> str:
     return os.path.join(UPLOAD_FOLDER, gara_id)
@@ -63,48 +133,209 @@ def get_pdf_file(gara_id: str) -> str:
 def get_index_file(gara_id: str) -> str:
     return os.path.join(get_gara_folder(gara_id), 'index.json')
 
+def get_pages_folder(gara_id: str) -> str:
+    return os.path.join(get_gara_folder(gara_id), 'pages')
+
+def get_page_filename(page_number: int) -> str:
+    return f"p{page_number:05d}.pdf"
+
 def salva_indice(indice: dict, gara_id: str) -> None:
     os.makedirs(get_gara_folder(gara_id), exist_ok=True)
-    with open(get_index_file(gara_id), "w", encoding="utf-8") as f:
-        json.dump(indice, f, ensure_ascii=False, indent=2)
+    path = get_index_file(gara_id)
+    # JSON compatto: file più piccolo e parsing più rapido rispetto all'indentato
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(indice))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(indice, f, ensure_ascii=False, separators=(",", ":"))
+    _INDEX_CACHE[gara_id] = (os.stat(path).st_mtime, indice, _trigrammi(indice))
+    # Aggiorna l'mtime di uploads/ così la cache delle gare si invalida in tutti i worker
+    os.utime(UPLOAD_FOLDER)
+
+def salva_pagine(pdf_path: str, gara_id: str) -> None:
+    """Divide il PDF in un file per pagina (uploads/<gara>/pages), servito poi senza PyMuPDF."""
+    pages_folder = get_pages_folder(gara_id)
+    tmp_folder = pages_folder + ".tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    if not SPLIT_PAGES:
+        # Eventuali pagine di un PDF precedente sarebbero comunque scadute
+        shutil.rmtree(pages_folder, ignore_errors=True)
+        return
+    os.makedirs(tmp_folder)
+    budget = SPLIT_PAGES_MAX_RATIO * os.path.getsize(pdf_path)
+    total = 0
+    try:
+        with fitz.open(pdf_path) as src:
+            for i in range(src.page_count):
+                with fitz.open() as out_doc:
+                    out_doc.insert_pdf(src, from_page=i, to_page=i)
+                    data = out_doc.write(
+                        garbage=4, deflate=True, deflate_images=True, clean=True, no_new_id=True,
+                    )
+                total += len(data)
+                if total > budget:
+                    # Risorse condivise duplicate in ogni pagina: non conviene
+                    logger.info(f"Suddivisione pagine saltata per '{gara_id}': oltre {SPLIT_PAGES_MAX_RATIO}x il PDF")
+                    shutil.rmtree(tmp_folder, ignore_errors=True)
+                    shutil.rmtree(pages_folder, ignore_errors=True)
+                    return
+                with open(os.path.join(tmp_folder, get_page_filename(i + 1)), "wb") as f:
+                    f.write(data)
+    except Exception as e:
+        # Senza file per pagina si ripiega sull'estrazione al volo
+        logger.error(f"Errore suddivisione pagine: {e}")
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        return
+    shutil.rmtree(pages_folder, ignore_errors=True)
+    os.rename(tmp_folder, pages_folder)
+
+def _trigrammi(indice: dict) -> dict[str, set[str]]:
+    """Trigramma -> nomi di by_name che lo contengono (solo in memoria, non salvato)."""
+    out = {}
+    for key in indice.get("by_name", {}):
+        for i in range(len(key) - 2):
+            out.setdefault(key[i:i + 3], set()).add(key)
+    return out
 
 def carica_indice(gara_id: str) -> dict:
+    """Carica index.json, riusando la copia in memoria finché il file non cambia."""
     path = get_index_file(gara_id)
-    if os.path.exists(path):
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        _INDEX_CACHE.pop(gara_id, None)
+        return {"by_bib": {}, "by_name": {}}
+    cached = _INDEX_CACHE.get(gara_id)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    if orjson is not None:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+    else:
         with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"by_bib": {}, "by_name": {}}
+            data = json.load(f)
+    _INDEX_CACHE[gara_id] = (mtime, data, _trigrammi(data))
+    return data
+
+def carica_trigrammi(gara_id: str) -> dict[str, set[str]]:
+    """Mappa trigramma -> nomi dell'indice corrente della gara."""
+    carica_indice(gara_id)
+    cached = _INDEX_CACHE.get(gara_id)
+    return cached[2] if cached else {}
+
+def cerca_nomi(by_name: dict, trigrammi: dict[str, set[str]], qn: str) -> list[int]:
+    """Pagine dei nomi che contengono qn come sottostringa.
+
+    I candidati sono i nomi che hanno tutti i trigrammi della query; la
+    verifica "qn in key" si fa solo su questi invece che su tutto by_name.
+    """
+    if len(qn) < 3:
+        keys = by_name.keys()
+    else:
+        sets = sorted((trigrammi.get(qn[i:i + 3], set()) for i in range(len(qn) - 2)), key=len)
+        keys = set(sets[0]).intersection(*sets[1:])
+    found = set()
+    for key in keys:
+        if qn in key:
+            found.update(by_name.get(key, ()))
+    return sorted(found)
+
+def descrivi_pdf(pdf_path: str) -> dict:
+    """Impronta del PDF sorgente (sha1, dimensione, mtime) salvata in index.json."""
+    sha1 = hashlib.sha1()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    st = os.stat(pdf_path)
+    return {"sha1": sha1.hexdigest(), "size": st.st_size, "mtime": st.st_mtime, "version": INDEX_VERSION}
+
+def stesso_sorgente(indice: dict, source: dict) -> bool:
+    """True se l'indice è stato creato dagli stessi byte PDF con la versione corrente."""
+    prev = indice.get("_source") or {}
+    return (
+        prev.get("version") == INDEX_VERSION
+        and prev.get("size") == source["size"]
+        and prev.get("sha1") == source["sha1"]
+    )
 
 def get_gare_disponibili() -> list:
+    """Elenco gare, ricalcolato solo quando cambia l'mtime della cartella uploads."""
+    global _GARE_CACHE
+    try:
+        mtime = os.stat(UPLOAD_FOLDER).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    cached = _GARE_CACHE
+    if cached and cached[0] == mtime:
+        return cached[1]
+
     gare = []
-    if os.path.exists(UPLOAD_FOLDER):
-        for item in os.listdir(UPLOAD_FOLDER):
-            gara_path = os.path.join(UPLOAD_FOLDER, item)
-            if os.path.isdir(gara_path):
-                pdf_file = get_pdf_file(item)
-                index_file = get_index_file(item)
-                gare.append({
-                    'id': item,
-                    'nome': item.replace('_', ' ').title(),
-                    'pdf_caricato': os.path.exists(pdf_file),
-                    'indice_creato': os.path.exists(index_file)
-                })
+    for item in os.listdir(UPLOAD_FOLDER):
+        gara_path = os.path.join(UPLOAD_FOLDER, item)
+        if os.path.isdir(gara_path):
+            pdf_file = get_pdf_file(item)
+            index_file = get_index_file(item)
+            gare.append({
+                'id': item,
+                'nome': item.replace('_', ' ').title(),
+                'pdf_caricato': os.path.exists(pdf_file),
+                'indice_creato': os.path.exists(index_file)
+            })
+    _GARE_CACHE = (mtime, gare)
     return gare
 
+def _get_doc(pdf_path: str) -> tuple[fitz.Document, threading.Lock]:
+    """Restituisce il PDF aperto (e il suo lock), riaprendolo solo se il file è cambiato."""
+    mtime = os.stat(pdf_path).st_mtime
+    with _DOC_CACHE_LOCK:
+        cached = _DOC_CACHE.get(pdf_path)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+        # Il documento precedente non viene chiuso qui: una richiesta in corso
+        # potrebbe ancora usarlo, lo chiude il GC quando non è più referenziato
+        doc = fitz.open(pdf_path)
+        lock = threading.Lock()
+        _DOC_CACHE[pdf_path] = (mtime, doc, lock)
+        return doc, lock
+
+def _cache_page(key: tuple[str, int, float], data: bytes) -> None:
+    global _PAGE_CACHE_BYTES
+    with _PAGE_CACHE_LOCK:
+        old = _PAGE_CACHE.pop(key, None)
+        if old is not None:
+            _PAGE_CACHE_BYTES -= len(old)
+        _PAGE_CACHE[key] = data
+        _PAGE_CACHE_BYTES += len(data)
+        while _PAGE_CACHE_BYTES > PAGE_CACHE_MAX_BYTES:
+            _, evicted = _PAGE_CACHE.popitem(last=False)
+            _PAGE_CACHE_BYTES -= len(evicted)
+
 def estrai_pagina(pdf_path: str, page_number: int) -> io.BytesIO | None:
     """Estrae la sola pagina richiesta in un buffer PDF."""
     try:
-        with fitz.open(pdf_path) as doc:
+        key = (pdf_path, page_number, os.path.getmtime(pdf_path))
+        with _PAGE_CACHE_LOCK:
+            data = _PAGE_CACHE.get(key)
+            if data is not None:
+                _PAGE_CACHE.move_to_end(key)
+                return io.BytesIO(data)
+
+        doc, lock = _get_doc(pdf_path)
+        with lock:
             idx = page_number - 1
             if idx < 0 or idx >= doc.page_count:
                 return None
             out_doc = fitz.open()
             out_doc.insert_pdf(doc, from_page=idx, to_page=idx)
-            buf = io.BytesIO()
-            out_doc.save(buf)
-            out_doc.close()
-            buf.seek(0)
-            return buf
+        # Serializzazione compatta fuori dal lock: il documento sorgente non serve più.
+        # no_new_id: niente /ID casuale, stessi byte a ogni estrazione (l'ETag è forte)
+        data = out_doc.write(garbage=4, deflate=True, deflate_images=True, clean=True, no_new_id=True)
+        out_doc.close()
+
+        if len(data) <= PAGE_CACHE_MAX_BYTES:
+            _cache_page(key, data)
+        return io.BytesIO(data)
     except Exception as e:
         logger.error(f"Errore estrazione pagina: {e}")
         return None
@@ -114,33 +345,43 @@ def estrai_pagina(pdf_path: str, page_number: int) -> io.BytesIO | None:
 # =============================
 
 def is_all_caps_name(line: str) -> bool:
-    raw = re.sub(r"\s+", " ", line or "").strip()
-    if not raw:
-        return False
-    raw_up = raw.upper()
-    if raw_up in LABELS_STOP:
-        return False
-    words = [w for w in raw_up.split() if len(w) >= 2]
-    if len(words) < 2:
-        return False
-    if not re.fullmatch(r"[A-ZÀ-Ÿ' \-]+", raw_up):
+    """Riga candidata a nome: solo maiuscole, almeno due parole di 2+ caratteri.
+
+    Un'unica passata sui caratteri, con uscita anticipata al primo carattere
+    non ammesso o appena le minuscole rendono impossibile il rapporto > 0.9.
+    """
+    line = line or ""
+    max_lower = len(line) / 10
+    total_alpha = lower = words = wlen = 0
+    for ch in line:
+        if ch.isspace():
+            if wlen >= 2:
+                words += 1
+            wlen = 0
+            continue
+        info = _CAPS_CHARS.get(ch)
+        if info is None:
+            return False
+        wlen += info[0]
+        total_alpha += info[1]
+        lower += info[2]
+        if lower >= max_lower:
+            return False
+    if wlen >= 2:
+        words += 1
+    if words < 2 or (total_alpha - lower) / max(1, total_alpha) <= 0.9:
         return False
-    total_alpha = sum(ch.isalpha() for ch in raw)
-    cap_ratio = sum(ch.isupper() for ch in raw if ch.isalpha()) / max(1, total_alpha)
-    return cap_ratio > 0.9
-
-def extract_bib_from_text(text: str) -> str | None:
-    t_flat = re.sub(r"\s+", " ", text or "", flags=re.UNICODE).strip()
-    m = re.search(r"numero\s*pettorale[^0-9]{0,100}?([0-9]{1,5})", t_flat, flags=re.IGNORECASE)
-    if m:
-        return m.group(1)
-    m2 = re.search(r"\bpettorale[^0-9]{0,50}?([0-9]{1,5})", t_flat, flags=re.IGNORECASE)
-    if m2:
-        return m2.group(1)
-    m3 = re.search(r"\bn[°o]\s*pettorale[^0-9]{0,50}?([0-9]{1,5})", t_flat, flags=re.IGNORECASE)
-    if m3:
-        return m3.group(1)
-    return None
+    return " ".join(line.split()).upper() not in LABELS_STOP
+
+def extract_bib_from_text(t_flat: str) -> str | None:
+    """Cerca il pettorale nel testo già normalizzato (spazi compressi, vedi flat_text)."""
+    m = _BIB_COMBINED.search(t_flat or "")
+    if not m:
+        return None
+    return m.group(1) or m.group(2) or m.group(3)
+
+def flat_text(text: str) -> str:
+    return _WS_RE.sub(" ", text or "").strip()
 
 def extract_name_from_blocks(blocks_texts: list[str]) -> str | None:
     candidates = []
@@ -150,12 +391,11 @@ def extract_name_from_blocks(blocks_texts: list[str]) -> str | None:
                 candidates.append(line.strip())
     if not candidates:
         return None
-    candidates = sorted(candidates, key=lambda s: abs(len(s) - 18))
-    return candidates[0]
+    return min(candidates, key=lambda s: abs(len(s) - 18))
 
 def extract_name_fallback_near_pettorale(text: str) -> str | None:
     lines = (text or "").splitlines()
-    idxs = [i for i, ln in enumerate(lines) if re.search(r"pettorale", ln, flags=re.IGNORECASE)]
+    idxs = [i for i, ln in enumerate(lines) if _PETTORALE_RE.search(ln)]
     window_lines = []
     for i in idxs[:1]:
         start = max(0, i - 5)
@@ -163,13 +403,13 @@ def extract_name_fallback_near_pettorale(text: str) -> str | None:
         window_lines.extend(lines[start:end])
 
     def is_caps_candidate(s):
-        s2 = re.sub(r"\s+", " ", s or "").strip()
+        s2 = _WS_RE.sub(" ", s or "").strip()
         if not s2:
             return False
         su = s2.upper()
         if su in LABELS_STOP:
             return False
-        if not re.fullmatch(r"[A-ZÀ-Ÿ' \-]{6,}", su):
+        if not _CAPS_CANDIDATE_RE.fullmatch(su):
             return False
         if len([w for w in su.split() if len(w) >= 2]) < 2:
             return False
@@ -177,45 +417,161 @@ def extract_name_fallback_near_pettorale(text: str) -> str | None:
 
     caps = [ln.strip() for ln in window_lines if is_caps_candidate(ln)]
     if caps:
-        caps.sort(key=lambda s: abs(len(s) - 18))
-        return caps[0]
+        return min(caps, key=lambda s: abs(len(s) - 18))
     return None
 
-def crea_indice(pdf_path: str) -> dict:
+def _index_page(page, page_num: int) -> tuple[int, str | None, str | None]:
+    """Estrae (pagina, pettorale, nome normalizzato) da una singola pagina."""
+    # TEXTFLAGS_BLOCKS esclude TEXT_PRESERVE_IMAGES: niente blocchi "<image: ...>"
+    # (le cui dimensioni finirebbero nel testo) né elaborazione di sfondi e loghi
+    blks = page.get_text("blocks", flags=fitz.TEXTFLAGS_BLOCKS) or []
+    blocks_texts = [b[4] for b in blks if isinstance(b, (list, tuple)) and len(b) >= 5 and isinstance(b[4], str)]
+    # Il testo piatto si ricava dai blocchi, evitando una seconda estrazione: ogni blocco
+    # termina già con "\n", quindi "".join dà lo stesso testo (e le stesse righe) di get_text()
+    text = "".join(blocks_texts) if blocks_texts else (page.get_text() or "")
+
+    # Normalizzazione degli spazi una sola volta per pagina; il testo a righe
+    # resta per il fallback sul nome, che lavora per linee
+    bib = extract_bib_from_text(flat_text(text))
+    name_raw = extract_name_from_blocks(blocks_texts) or extract_name_fallback_near_pettorale(text)
+
+    key = None
+    if name_raw:
+        key = norm(name_raw)
+    elif not bib:
+        m2 = _TWOWORD_RE.search(text)
+        if m2:
+            key = norm(f"{m2.group(1)} {m2.group(2)}")
+    return page_num, bib, key
+
+def _index_range(doc: fitz.Document, start: int, stop: int) -> tuple[list[tuple[int, str | None, str | None]], int]:
+    """Indicizza le pagine [start, stop) di un documento aperto; restituisce risultati e pagine fallite."""
+    results = []
+    failed = 0
+    for i in range(start, stop):
+        try:
+            results.append(_index_page(doc[i], i + 1))
+        except Exception as e:
+            # Una pagina malformata non deve far perdere le altre
+            logger.error(f"Errore indicizzazione pagina {i + 1}: {e}")
+            failed += 1
+    return results, failed
+
+def _index_pages(pdf_path: str, start: int, stop: int) -> tuple[list[tuple[int, str | None, str | None]], int]:
+    """Come _index_range, aprendo il PDF una sola volta (eseguita nei worker)."""
+    with fitz.open(pdf_path) as doc:
+        return _index_range(doc, start, stop)
+
+def _merge_pages(out: dict, results: list[tuple[int, str | None, str | None]]) -> None:
+    for page_num, bib, key in results:
+        if bib:
+            out["by_bib"][bib] = page_num
+        if key is not None:
+            out["by_name"].setdefault(key, set()).add(page_num)
+
+def crea_indice(pdf_path: str) -> tuple[dict, bool]:
+    """Indicizza il PDF; restituisce (indice, completo).
+
+    In caso di errori l'indice contiene comunque le pagine riuscite, ma completo è False.
+    """
     out = {"by_bib": {}, "by_name": {}}
+    completo = True
     try:
         with fitz.open(pdf_path) as doc:
-            for page_num, page in enumerate(doc, start=1):
-                text = page.get_text() or ""
-                blks = page.get_text("blocks") or []
-                blocks_texts = [b[4] for b in blks if isinstance(b, (list, tuple)) and len(b) >= 5 and isinstance(b[4], str)]
-
-                bib = extract_bib_from_text(text)
-                name_raw = extract_name_from_blocks(blocks_texts) or extract_name_fallback_near_pettorale(text)
-
-                if bib:
-                    out["by_bib"][bib] = page_num
-                if name_raw:
-                    key = norm(name_raw)
-                    out["by_name"].setdefault(key, [])
-                    if page_num not in out["by_name"][key]:
-                        out["by_name"][key].append(page_num)
-
-                if not bib and not name_raw:
-                    m2 = re.search(r"\b([A-Z][a-zà-ÿ]+)\s+([A-Z][a-zà-ÿ]+)\b", text)
-                    if m2:
-                        key = norm(f"{m2.group(1)} {m2.group(2)}")
-                        out["by_name"].setdefault(key, [])
-                        if page_num not in out["by_name"][key]:
-                            out["by_name"][key].append(page_num)
+            page_count = doc.page_count
+            workers = min(INDEX_MAX_WORKERS, page_count // INDEX_MIN_PAGES_PER_WORKER)
+            if workers <= 1:
+                # Un'unica apertura e un'unica passata, senza processi aggiuntivi
+                results, failed = _index_range(doc, 0, page_count)
+                _merge_pages(out, results)
+                completo = not failed
+
+        if workers > 1:
+            # Un solo intervallo contiguo per worker: ogni riapertura del PDF
+            # ricostruisce la tabella delle pagine, quindi se ne fanno il meno possibile
+            step = -(-page_count // workers)
+            ranges = [(s, min(s + step, page_count)) for s in range(0, page_count, step)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_index_pages, pdf_path, s, e) for s, e in ranges]
+                # Unione in ordine di pagina: un worker fallito (es. terminato)
+                # non fa perdere le pagine degli altri
+                for (start, stop), future in zip(ranges, futures):
+                    try:
+                        results, failed = future.result()
+                        _merge_pages(out, results)
+                        completo = completo and not failed
+                    except Exception as e:
+                        logger.error(f"Errore indicizzazione pagine {start + 1}-{stop}: {e}")
+                        completo = False
     except Exception as e:
         logger.error(f"Errore indicizzazione PDF: {e}")
-    return out
+        completo = False
+
+    # Set durante la costruzione, liste ordinate per il salvataggio in JSON
+    out["by_name"] = {k: sorted(v) for k, v in out["by_name"].items()}
+    return out, completo
 
 # =============================
 #   ROUTES
 # =============================
 
+def _revalida_sempre(resp: Response) -> Response:
+    """Cache solo nel browser e sempre rivalidata tramite ETag.
+
+    Gli URL non sono versionati: dopo un nuovo caricamento del PDF il client
+    deve ricevere subito il nuovo attestato, e i proxy condivisi non devono
+    conservare attestati cercati per nome.
+    """
+    resp.cache_control.public = False
+    resp.cache_control.max_age = None
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+def _pdf_response(gara_id: str, page_num: int, download_name: str) -> Response | None:
+    """Download della pagina con ETag/Last-Modified; None se l'estrazione fallisce."""
+    # La pagina estratta dipende solo da (PDF, pagina, mtime): se il client ha
+    # già questo ETag si risponde 304 senza alcun lavoro su PyMuPDF
+    pdf_file = get_pdf_file(gara_id)
+    mtime = os.path.getmtime(pdf_file)
+    etag = hashlib.md5(f"{pdf_file}:{page_num}:{mtime}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return _revalida_sempre(resp)
+
+    # Pagina già divisa al caricamento (e non più vecchia del PDF): file statico
+    pages_folder = get_pages_folder(gara_id)
+    page_name = get_page_filename(page_num)
+    try:
+        page_is_fresh = os.path.getmtime(os.path.join(pages_folder, page_name)) >= mtime
+    except OSError:
+        page_is_fresh = False
+    if page_is_fresh:
+        return _revalida_sempre(send_from_directory(
+            pages_folder,
+            page_name,
+            download_name=download_name,
+            as_attachment=True,
+            mimetype="application/pdf",
+            etag=etag,
+            last_modified=mtime,
+        ))
+
+    pdf_buffer = estrai_pagina(pdf_file, page_num)
+    if pdf_buffer is None:
+        return None
+    return _revalida_sempre(send_file(
+        pdf_buffer,
+        download_name=download_name,
+        as_attachment=True,
+        mimetype="application/pdf",
+        conditional=True,
+        etag=etag,
+        last_modified=mtime,
+    ))
+
+
 @attestati_bp.route("/upload", methods=["POST"])
 @cross_origin()
 @jwt_required()
@@ -238,16 +594,38 @@ def upload_pdf():
     gara_folder = get_gara_folder(gara_id)
     os.makedirs(gara_folder, exist_ok=True)
     file_path = get_pdf_file(gara_id)
-    file.save(file_path)
+    tmp_path = file_path + ".upload"
+    file.save(tmp_path)
+
+    # Stesso file già caricato e indicizzato: si mantiene quello esistente
+    # (mtime invariato, quindi restano valide anche cache e pagine divise)
+    source = descrivi_pdf(tmp_path)
+    indice = carica_indice(gara_id)
+    if os.path.exists(file_path) and stesso_sorgente(indice, source):
+        os.remove(tmp_path)
+        if not os.path.isdir(get_pages_folder(gara_id)):
+            salva_pagine(file_path, gara_id)
+        return jsonify({
+            "message": f"PDF invariato: indice già aggiornato per la gara '{gara_id}'",
+            "gara_id": gara_id,
+            "totale_bib": len(indice.get("by_bib", {})),
+            "totale_nomi": len(indice.get("by_name", {}))
+        }), 200
 
-    indice = crea_indice(file_path)
+    os.replace(tmp_path, file_path)
+    indice, completo = crea_indice(file_path)
+    if completo:
+        # Impronta solo per indici completi: dopo un errore /reindex deve rigenerare
+        indice["_source"] = source
     salva_indice(indice, gara_id)
+    salva_pagine(file_path, gara_id)
 
     return jsonify({
         "message": f"File caricato e indicizzato per la gara '{gara_id}'",
         "gara_id": gara_id,
         "totale_bib": len(indice.get("by_bib", {})),
-        "totale_nomi": len(indice.get("by_name", {}))
+        "totale_nomi": len(indice.get("by_name", {})),
+        "indice_completo": completo
     }), 201
 
 
@@ -257,18 +635,34 @@ def upload_pdf():
 def reindex():
     data = request.get_json(silent=True) or {}
     gara_id = (data.get("gara_id") or "").strip()
+    force = bool(data.get("force"))
     if not gara_id:
         return jsonify({"error": "ID gara richiesto"}), 400
     pdf_file = get_pdf_file(gara_id)
     if not os.path.exists(pdf_file):
         return jsonify({"error": f"PDF non caricato per la gara '{gara_id}'"}), 404
 
-    indice = crea_indice(pdf_file)
+    source = descrivi_pdf(pdf_file)
+    indice = carica_indice(gara_id)
+    if not force and stesso_sorgente(indice, source):
+        if not os.path.isdir(get_pages_folder(gara_id)):
+            salva_pagine(pdf_file, gara_id)
+        return jsonify({
+            "message": f"PDF invariato: indice già aggiornato per '{gara_id}'",
+            "totale_bib": len(indice.get("by_bib", {})),
+            "totale_nomi": len(indice.get("by_name", {}))
+        }), 200
+
+    indice, completo = crea_indice(pdf_file)
+    if completo:
+        indice["_source"] = source
     salva_indice(indice, gara_id)
+    salva_pagine(pdf_file, gara_id)
     return jsonify({
         "message": f"Indice rigenerato per '{gara_id}'",
         "totale_bib": len(indice.get("by_bib", {})),
-        "totale_nomi": len(indice.get("by_name", {}))
+        "totale_nomi": len(indice.get("by_name", {})),
+        "indice_completo": completo
     }), 200
 
 
@@ -294,24 +688,16 @@ def cerca_attestato():
 
     if query.isdigit() and query in by_bib:
         page_num = by_bib[query]
-        pdf_buffer = estrai_pagina(pdf_file, page_num)
-        if pdf_buffer:
-            return send_file(
-                pdf_buffer,
-                download_name=f"attestato_{gara_id}_pettorale_{query}.pdf",
-                as_attachment=True,
-                mimetype="application/pdf"
-            )
+        resp = _pdf_response(gara_id, page_num, f"attestato_{gara_id}_pettorale_{query}.pdf")
+        if resp is not None:
+            return resp
         return jsonify({"error": "Errore nell'estrazione PDF"}), 500
 
     qn = norm(query)
     pages = list(by_name.get(qn, []))
 
     if not pages:
-        for key, vals in by_name.items():
-            if qn in key:
-                pages.extend(vals)
-        pages = sorted(set(pages))
+        pages = cerca_nomi(by_name, carica_trigrammi(gara_id), qn)
 
     if not pages:
         return jsonify({"error": f"Attestato non trovato per '{query}' nella gara '{gara_id}'"}), 404
@@ -326,15 +712,10 @@ def cerca_attestato():
         }), 200
 
     page_num = pages[0]
-    pdf_buffer = estrai_pagina(pdf_file, page_num)
-    if pdf_buffer:
-        safe_q = re.sub(r"[^a-zA-Z0-9_\-]", "_", query)[:50]
-        return send_file(
-            pdf_buffer,
-            download_name=f"attestato_{gara_id}_{safe_q}.pdf",
-            as_attachment=True,
-            mimetype="application/pdf"
-        )
+    safe_q = re.sub(r"[^a-zA-Z0-9_\-]", "_", query)[:50]
+    resp = _pdf_response(gara_id, page_num, f"attestato_{gara_id}_{safe_q}.pdf")
+    if resp is not None:
+        return resp
     return jsonify({"error": "Errore nell'estrazione PDF"}), 500
 
 
@@ -351,14 +732,9 @@ def singola_pagina():
     if not os.path.exists(pdf_file):
         return jsonify({"error": f"PDF non caricato per la gara '{gara_id}'"}), 404
 
-    pdf_buffer = estrai_pagina(pdf_file, page)
-    if pdf_buffer:
-        return send_file(
-            pdf_buffer,
-            download_name=f"attestato_{gara_id}_p{page}.pdf",
-            as_attachment=True,
-            mimetype="application/pdf"
-        )
+    resp = _pdf_response(gara_id, page, f"attestato_{gara_id}_p{page}.pdf")
+    if resp is not None:
+        return resp
     return jsonify({"error": "Errore nell'estrazione PDF"}), 500
 
 
@@ -415,7 +791,8 @@ def debug_page_text():
     if not os.path.exists(pdf_file):
         return jsonify({"error": f"PDF non caricato per la gara '{gara_id}'"}), 404
     try:
-        with fitz.open(pdf_file) as doc:
+        doc, lock = _get_doc(pdf_file)
+        with lock:
             idx = page - 1
             if idx < 0 or idx >= doc.page_count:
                 return jsonify({"error": "Pagina fuori range"}), 400
@@ -423,7 +800,7 @@ def debug_page_text():
             return jsonify({
                 "page": page,
                 "text": p.get_text(),
-                "blocks": [b[4] for b in p.get_text("blocks") if isinstance(b, (list, tuple)) and len(b) >= 5 and isinstance(b[4], str)]
+                "blocks": [b[4] for b in p.get_text("blocks", flags=fitz.TEXTFLAGS_BLOCKS) if isinstance(b, (list, tuple)) and len(b) >= 5 and isinstance(b[4], str)]
             }), 200
     except Exception as e:
         logger.error(f"Errore lettura pagina: {e}")